@@ -0,0 +1,91 @@
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+os.environ.setdefault("CONFIG_FILE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yml"))
+
+# The gateway loads its config on import, so the path has to be set first
+import dynamic_assignment_network as gateway
+from live_feed import LiveFeed
+
+# --- Benchmark of the full QC flush path against the ingest rate it must sustain ---
+#
+# Each station's firmware loop sends one LoRa message per reading: si7021 (2),
+# bme680 (3), tmp117 (1), ltr390 (1), pmsa003i (12), gps (1) and scd40 (1),
+# then sleeps at least one second. That bounds ingest at ~21 readings/s per
+# station. The target assumes a large field campaign of TARGET_STATIONS
+# stations all sending at that rate on a single gateway core.
+
+READINGS_PER_STATION_PER_SECOND = 21
+TARGET_STATIONS = 500
+TARGET_READINGS_PER_SECOND = READINGS_PER_STATION_PER_SECOND * TARGET_STATIONS
+
+MEASUREMENTS = [
+    ("si7021", "temperature", 20.0, 1.0), ("si7021", "humidity", 50.0, 5.0),
+    ("bme680", "temperature", 20.0, 1.0), ("bme680", "humidity", 50.0, 5.0), ("bme680", "pressure", 840.0, 1.0),
+    ("tmp117", "temperature", 20.0, 1.0), ("ltr390", "uv", 0.0, 0.0), ("scd40", "co2", 420.0, 20.0),
+] + [("pmsa003i", name, 5.0, 2.0) for name in (
+    "pm10standard", "pm25standard", "pm100standard", "pm10env", "pm25env", "pm100env",
+    "partcount03um", "partcount05um", "partcount10um", "partcount25um", "partcount50um", "partcount100um",
+)]
+
+
+def make_batches(stations, batches, batch_size, seed):
+    """Synthetic edge payload readings in the gateway's queue format, with ~2% bad values."""
+    rng = np.random.default_rng(seed)
+    prepared = []
+    for _ in range(batches):
+        picks = rng.integers(0, len(MEASUREMENTS), batch_size).tolist()
+        station_ids = rng.integers(0, stations, batch_size).tolist()
+        noise = rng.normal(0, 1, batch_size).tolist()
+        corrupt = (rng.random(batch_size) < 0.02).tolist()
+        batch = []
+        for pick, station, z, bad in zip(picks, station_ids, noise, corrupt):
+            sensor, measurement, mean, spread = MEASUREMENTS[pick]
+            value = 99999.0 if bad else round(max(mean + z * spread, 0.0), 2)
+            batch.append((f"station_{station}", sensor, measurement, {measurement: value}))
+        prepared.append(batch)
+    return prepared
+
+
+def benchmark(stations=TARGET_STATIONS, batch_size=500, batches=200, seed=0):
+    """Time flush_quality_control end to end (QC, caching, QC flags and live feed publish)."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        gateway.init_quality_control()
+        feed = LiveFeed("127.0.0.1", 0)
+        feed.start()
+        gateway.live_feed = feed if feed.loop else None
+    for station in range(stations):
+        gateway.stations[f"station_{station}"] = {
+            "latitude": None, "longitude": None, "gps_fixed": None,
+            "measurements": {}, "qc_flags": {}, "unsent": set(), "thingsboard_id": None,
+        }
+
+    prepared = make_batches(stations, batches, batch_size, seed)
+    # Rejection warnings are part of the path; send them to a buffer instead of the terminal
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for batch in prepared:
+            gateway.qc_pending.extend(batch)
+            gateway.flush_quality_control()
+    elapsed = time.perf_counter() - started
+
+    total = batch_size * batches
+    rate = total / elapsed
+    print(f"[info]: QC flush benchmark: {total} readings in {elapsed:.3f}s "
+          f"({rate:,.0f} readings/s, {elapsed / batches * 1000:.2f} ms per {batch_size}-reading batch)")
+    print(f"[info]: Target ingest rate: {TARGET_READINGS_PER_SECOND:,} readings/s "
+          f"({TARGET_STATIONS} stations x {READINGS_PER_STATION_PER_SECOND} readings/s)")
+    if rate < TARGET_READINGS_PER_SECOND:
+        print(f"[error]: QC flush path is {TARGET_READINGS_PER_SECOND / rate:.1f}x too slow for the target ingest rate")
+        return False
+    print(f"[info]: QC flush path keeps up with {rate / TARGET_READINGS_PER_SECOND:.1f}x headroom")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if benchmark() else 1)
@@ -1,10 +1,14 @@
 import json
+import math
 import os
 import requests
 import paho.mqtt.client as mqtt
+import threading
 import time
 import uuid  # For generating unique IDs
 import yaml  # For loading the config file
+from live_feed import LiveFeed
+from quality_control import BatchQualityControl, flag_names
 
 # Load configuration settings from config.yml
 def load_config():
@@ -31,6 +35,21 @@ stations = {}
 # Global JWT token
 jwt_token = None
 
+# Push feed for live map clients (started in main when enabled)
+live_feed = None
+
+# Quality control stage: readings are buffered and checked in micro-batches
+quality_control = None
+qc_pending = []
+qc_lock = threading.Lock()
+
+# Guards each station's set of measurements received since the last upload
+upload_lock = threading.Lock()
+
+# Station positions waiting to be written as server attributes
+pending_positions = {}
+position_lock = threading.Lock()
+
 # --- ThingsBoard API Interaction ---
 
 def get_jwt_token():
@@ -270,34 +289,226 @@ def set_telemetry(station_id, telemetry_data, token):
         return False
 # Function to send station data to ThingsBoard (update telemetry)
 def send_station_data_to_thingsboard(station_id):
-    """Send the station's latitude, longitude, and measurements to ThingsBoard as telemetry."""
+    """Send the station's measurements received since the last upload to ThingsBoard as telemetry.
+
+    Position is not part of the telemetry; it is kept as server attributes
+    (see queue_position_update).
+    """
     station = stations.get(station_id)
     if not station:
         print(f"[warn]: Station {station_id} not found for telemetry.")
         return
-    
-    # Prepare telemetry data
-    telemetry_data = {
-        "latitude": station["latitude"],
-        "longitude": station["longitude"],
-        "gps_fixed": station["gps_fixed"]
-    }
-    
-    # Add measurements as individual telemetry values
-    for measurement_name, measurement_value in station["measurements"].items():
-        telemetry_data[measurement_name] = measurement_value
-    
+
+    with upload_lock:
+        unsent = station["unsent"]
+        station["unsent"] = set()
+        telemetry_data = {}
+        for measurement_name in unsent:
+            # Add measurements as individual telemetry values
+            telemetry_data[measurement_name] = station["measurements"][measurement_name]
+            # Attach QC flags for measurements that were kept but flagged
+            flags = station["qc_flags"].get(measurement_name)
+            if flags:
+                telemetry_data[f"{measurement_name}_qc"] = flags
+    if not telemetry_data:
+        return
+
     token = get_jwt_token()
+    success = False
     if not token:
         print(f"[error]: Unable to get a valid token to set telemetry for Station_{station_id}.")
-        return
-
-    # Send the telemetry - THIS WAS MISSING IN YOUR CODE
-    success = set_telemetry(station_id, telemetry_data, token)
+    else:
+        # Send the telemetry - THIS WAS MISSING IN YOUR CODE
+        success = set_telemetry(station_id, telemetry_data, token)
     if success:
         print(f"[info]: Telemetry successfully sent for station {station_id}")
     else:
         print(f"[error]: Failed to send telemetry for station {station_id}")
+        # Keep the measurements for the next upload
+        with upload_lock:
+            station["unsent"] |= unsent
+
+def init_quality_control():
+    """Create the batch QC stage from the config, or leave it disabled."""
+    global quality_control
+    qc_config = config.get('quality_control') or {}
+    if not qc_config.get('enabled', False):
+        print("[info]: Quality control disabled in configuration.")
+        return None
+
+    quality_control = BatchQualityControl(
+        limits=qc_config.get('limits'),
+        history_size=qc_config.get('history_size', 16),
+        min_history=qc_config.get('min_history', 4),
+        stuck_count=qc_config.get('stuck_count', 12),
+        stuck_tolerance=qc_config.get('stuck_tolerance', 1e-6),
+        spike_reseed=qc_config.get('spike_reseed', 5),
+        reject_flags=qc_config.get('reject_flags', ["range", "spike"]),
+    )
+    print("[info]: Quality control enabled.")
+    return quality_control
+
+def reading_value(measurement, data):
+    """Extract the numeric value from a reading's data (edge servers send {measurement: value})."""
+    if isinstance(data, dict):
+        if measurement in data:
+            return data[measurement]
+        if len(data) == 1:
+            return next(iter(data.values()))
+        return None
+    return data
+
+def store_measurement(station_id, measurement, data, flags=0):
+    """Cache a measurement for the next upload and forward it to the live feed."""
+    station = stations[station_id]
+    with upload_lock:
+        station["measurements"][measurement] = data
+        station["qc_flags"][measurement] = flags
+        station["unsent"].add(measurement)
+    # The feed carries the bare value ({"temperature": 20.5}), not the edge payload
+    publish_live_update(station_id, {measurement: reading_value(measurement, data)})
+
+def queue_reading_for_qc(station_id, sensor, measurement, data):
+    """Buffer a reading for the next QC batch, flushing early once the batch is full."""
+    if not quality_control:
+        store_measurement(station_id, measurement, data)
+        return
+
+    with qc_lock:
+        qc_pending.append((station_id, sensor, measurement, data))
+        batch_full = len(qc_pending) >= int(config['quality_control'].get('batch_size', 500))
+    if batch_full:
+        flush_quality_control()
+
+def check_single_reading(reading):
+    """Run QC on one reading; returns (None, False) if it cannot be checked."""
+    try:
+        flags, accepted = quality_control.check([reading])
+        return int(flags[0]), bool(accepted[0])
+    except Exception as e:
+        print(f"[error]: QC dropped unreadable reading {reading}: {e}")
+        return None, False
+
+def flush_quality_control():
+    """Run QC over the buffered readings and keep the accepted ones."""
+    if not quality_control:
+        return
+
+    with qc_lock:
+        if not qc_pending:
+            return
+        batch = qc_pending[:]
+        qc_pending.clear()
+
+        readings = [(station_id, sensor, measurement, reading_value(measurement, data))
+                    for station_id, sensor, measurement, data in batch]
+        try:
+            flags, accepted = quality_control.check(readings)
+            results = zip(flags.tolist(), accepted.tolist())
+        except Exception as e:
+            # Re-check one reading at a time so a single bad reading only loses itself
+            print(f"[error]: QC failed on a batch of {len(readings)} readings, checking them one by one: {e}")
+            results = [check_single_reading(reading) for reading in readings]
+
+        for (station_id, sensor, measurement, data), (reading_flags, keep) in zip(batch, results):
+            if reading_flags is None:
+                continue
+            if not keep:
+                print(f"[warn]: QC rejected {measurement} from {sensor} on station {station_id}: {data} ({', '.join(flag_names(reading_flags))})")
+                continue
+            store_measurement(station_id, measurement, data, reading_flags)
+
+def publish_live_update(station_id, fields):
+    """Forward changed station fields to the live feed, if it is running."""
+    if live_feed:
+        live_feed.publish(station_id, fields)
+
+def start_live_feed():
+    """Start the SSE fan-out server for live map clients if enabled in the config."""
+    global live_feed
+    feed_config = config.get('live_feed') or {}
+    if not feed_config.get('enabled', False):
+        print("[info]: Live feed disabled in configuration.")
+        return None
+
+    feed = LiveFeed(feed_config.get('host', '0.0.0.0'), int(feed_config.get('port', 8081)))
+    feed.start()
+    if feed.loop is None:
+        print("[error]: Live feed failed to start. Continuing without it.")
+        return None
+    live_feed = feed
+    return live_feed
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters between two WGS84 points."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+def queue_position_update(station_id):
+    """Queue a position attribute write if the station moved past the threshold or its fix changed."""
+    station = stations[station_id]
+    try:
+        latitude = float(station["latitude"])
+        longitude = float(station["longitude"])
+    except (TypeError, ValueError):
+        print(f"[warn]: Invalid GPS position for station {station_id}: {station['latitude']}, {station['longitude']}")
+        return
+
+    reported = station.get("reported_position")
+    if reported:
+        threshold = float((config.get('gps') or {}).get('move_threshold_m', 25))
+        moved = haversine_m(reported["latitude"], reported["longitude"], latitude, longitude)
+        if moved <= threshold and reported["gps_fixed"] == station["gps_fixed"]:
+            return
+
+    position = {"latitude": latitude, "longitude": longitude, "gps_fixed": station["gps_fixed"]}
+    station["reported_position"] = position
+    with position_lock:
+        pending_positions[station_id] = position
+
+def requeue_positions(positions):
+    """Put unwritten positions back for the next flush, unless a newer fix was queued meanwhile."""
+    with position_lock:
+        for station_id, position in positions.items():
+            pending_positions.setdefault(station_id, position)
+
+def flush_position_attributes():
+    """Write queued station positions to ThingsBoard as SERVER_SCOPE attributes.
+
+    ThingsBoard's REST API takes attributes per device, so a flush is one
+    request per station that changed since the previous flush, however many
+    fixes it reported in between.
+    """
+    with position_lock:
+        if not pending_positions:
+            return
+        batch = dict(pending_positions)
+        pending_positions.clear()
+
+    token = get_jwt_token()
+    if not token:
+        print("[error]: Unable to get a valid token to write station positions.")
+        requeue_positions(batch)
+        return
+
+    headers = {
+        'X-Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json'
+    }
+    failed = {}
+    for station_id, position in batch.items():
+        device_id = stations[station_id]["thingsboard_id"]
+        url = f"{config['thingsboard']['api_url']}/api/plugins/telemetry/DEVICE/{device_id}/SERVER_SCOPE"
+        response = make_request_with_token_refresh(url, headers, method='POST', json_data=position)
+        if response:
+            print(f"[info]: Updated position attributes for station {station_id}")
+        else:
+            print(f"[error]: Failed to update position attributes for station {station_id}")
+            failed[station_id] = position
+    requeue_positions(failed)
 
 # MQTT client setup
 def on_connect(client, userdata, flags, rc):
@@ -328,7 +539,7 @@ def on_message(client, userdata, msg):
 
         # Initialize station data if it's new
         if station_id not in stations:
-            stations[station_id] = {"latitude": None, "longitude": None, "gps_fixed": None, "measurements": {}, "thingsboard_id": device_tb_id}
+            stations[station_id] = {"latitude": None, "longitude": None, "gps_fixed": None, "measurements": {}, "qc_flags": {}, "unsent": set(), "thingsboard_id": device_tb_id}
         stations[station_id]["thingsboard_id"] = device_tb_id
 
         # Handle GPS data
@@ -339,13 +550,18 @@ def on_message(client, userdata, msg):
                 stations[station_id]["latitude"] = latitude
                 stations[station_id]["longitude"] = longitude
                 stations[station_id]["gps_fixed"] = gps_fix
+                publish_live_update(station_id, {"latitude": latitude, "longitude": longitude, "gps_fixed": gps_fix})
+                queue_position_update(station_id)
                 send_station_data_to_thingsboard(station_id)
 
-        # Handle other measurements
-        if payload.get('measurement') and payload.get('sensor'):
+        # Handle other measurements (GPS fixes are kept as position attributes instead)
+        elif payload.get('measurement') and payload.get('sensor'):
             measurement = payload.get('measurement')
-            data = payload.get('data')
-            stations[station_id]["measurements"][measurement] = data
+            sensor = payload.get('sensor')
+            if not isinstance(measurement, str) or not isinstance(sensor, str):
+                print(f"[error]: Invalid sensor or measurement name in payload: {payload}")
+                return
+            queue_reading_for_qc(station_id, sensor, measurement, payload.get('data'))
 
     except Exception as e:
         print(f"Error processing message: {e}")
@@ -436,8 +652,12 @@ def add_dynamic_map_widget(dashboard_id, token):
             }
         }
 
-    # 5. Configure map widget
+    # 5. Configure map widget; station position is stored as server attributes, not telemetry
     widget_id = str(uuid.uuid4())
+    position_keys = [
+        {"name": key_name, "type": "attribute", "label": key_name}
+        for key_name in ("latitude", "longitude", "gps_fixed")
+    ]
     widget_config = {
         "type": "latest",
         "sizeX": 12,
@@ -448,6 +668,11 @@ def add_dynamic_map_widget(dashboard_id, token):
             "title": "GPS Stations",
             "showTitle": True,
             "entityAliasId": alias_id,
+            "datasources": [{
+                "type": "entity",
+                "entityAliasId": alias_id,
+                "dataKeys": position_keys
+            }],
             "latitudeKeyName": "latitude",
             "longitudeKeyName": "longitude",
             "showLabel": True,
@@ -502,15 +727,25 @@ def main():
     if not widget_response:
         print("[critical]: Unable to add or update map widget. Continuing without map setup.")
 
+    start_live_feed()
+    init_quality_control()
     start_mqtt_client()
 
     print("[info]: Gateway is running. Waiting for MQTT messages...")
     try:
+        flush_interval = float((config.get('quality_control') or {}).get('flush_interval', 1))
+        position_interval = float((config.get('gps') or {}).get('attribute_flush_interval', 30))
+        last_position_flush = time.time()
         while True:
-            time.sleep(1)  # Keep the main thread alive
+            time.sleep(flush_interval)  # Keep the main thread alive
+            flush_quality_control()  # Check readings that did not fill a whole batch
+            if time.time() - last_position_flush >= position_interval:
+                flush_position_attributes()
+                last_position_flush = time.time()
     except KeyboardInterrupt:
         print("[info]: KeyboardInterrupt detected. Shutting down...")
     finally:
+        flush_position_attributes()
         print("[info]: Shutting down MQTT client.")
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import threading
+import time
+
+# --- Live station feed (Server-Sent Events) ---
+#
+# A single asyncio loop runs in a background thread and fans out per-station
+# deltas to every connected browser. The MQTT thread hands updates over with
+# publish(); each client keeps its own pending dict keyed by station so a slow
+# consumer only ever holds the latest values for each station instead of an
+# ever-growing queue, and never blocks the other clients.
+
+KEEPALIVE_INTERVAL = 15  # seconds between SSE comment lines on idle streams
+
+
+class _Client:
+    """Per-connection state: pending deltas coalesced by station id."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = {}
+        self.wakeup = asyncio.Event()
+
+    def push(self, station_id, fields):
+        self.pending.setdefault(station_id, {}).update(fields)
+        self.wakeup.set()
+
+    def take(self):
+        pending, self.pending = self.pending, {}
+        self.wakeup.clear()
+        return pending
+
+
+class LiveFeed:
+    """Streams latest station state to map clients over Server-Sent Events.
+
+    Endpoints:
+        GET /stream   - SSE stream; a "snapshot" event followed by "delta" events
+        GET /snapshot - the current state of every station as one JSON document
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.state = {}
+        self.clients = set()
+        self._server = None
+        self._ready = threading.Event()
+
+    # Called from any thread (e.g. the MQTT client thread)
+    def publish(self, station_id, fields):
+        """Queue a partial update for a station. Only changed fields need to be passed."""
+        if not fields or self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self._apply, station_id, dict(fields))
+
+    def start(self):
+        """Run the feed's event loop in a daemon thread and wait until it is listening."""
+        thread = threading.Thread(target=self._run, name="live-feed", daemon=True)
+        thread.start()
+        self._ready.wait(timeout=10)
+        return thread
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self._server = self.loop.run_until_complete(
+                asyncio.start_server(self._handle_connection, self.host, self.port)
+            )
+            print(f"[info]: Live feed listening on {self.host}:{self.port}")
+        except OSError as e:
+            print(f"[error]: Failed to start live feed on {self.host}:{self.port}: {e}")
+            self.loop = None
+            return
+        finally:
+            self._ready.set()
+        self.loop.run_forever()
+
+    # Runs on the feed's event loop
+    def _apply(self, station_id, fields):
+        current = self.state.setdefault(station_id, {})
+        changed = {key: value for key, value in fields.items() if current.get(key) != value}
+        if not changed:
+            return
+        current.update(changed)
+        for client in self.clients:
+            client.push(station_id, changed)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            # Drain the request headers; nothing in them is needed
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=10)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+
+        parts = request_line.decode("latin-1").split()
+        method = parts[0] if parts else ""
+        path = parts[1].split("?", 1)[0] if len(parts) > 1 else ""
+
+        try:
+            if method != "GET":
+                await self._send_response(writer, "405 Method Not Allowed", "text/plain", b"Method not allowed\n")
+            elif path == "/stream":
+                await self._stream(writer)
+            elif path == "/snapshot":
+                body = json.dumps(self.state).encode()
+                await self._send_response(writer, "200 OK", "application/json", body)
+            else:
+                await self._send_response(writer, "404 Not Found", "text/plain", b"Not found\n")
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _send_response(self, writer, status, content_type, body):
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Access-Control-Allow-Origin: *\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    async def _stream(self, writer):
+        client = _Client(writer)
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Access-Control-Allow-Origin: *\r\n"
+            b"Connection: keep-alive\r\n\r\n"
+        )
+        # Snapshot and registration happen without yielding, so no delta can slip in between
+        writer.write(self._event("snapshot", self.state))
+        self.clients.add(client)
+        print(f"[info]: Live feed client connected ({len(self.clients)} total)")
+        try:
+            await writer.drain()
+            while True:
+                try:
+                    await asyncio.wait_for(client.wakeup.wait(), timeout=KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    writer.write(b": keepalive\n\n")
+                else:
+                    writer.write(self._event("delta", client.take()))
+                await writer.drain()
+        finally:
+            self.clients.discard(client)
+            print(f"[info]: Live feed client disconnected ({len(self.clients)} total)")
+
+    @staticmethod
+    def _event(name, data):
+        payload = {"ts": int(time.time() * 1000), "stations": data}
+        return f"event: {name}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n".encode()
@@ -0,0 +1,271 @@
+import math
+
+import numpy as np
+
+# --- Batch quality control for incoming readings ---
+#
+# Readings are checked in micro-batches with NumPy array operations. Per-series
+# state (last good value, recent history ring buffer, repeat counter) lives in
+# flat arrays indexed by an integer series id, so one batch costs a handful of
+# vectorized passes regardless of how many stations or sensors it spans.
+
+FLAG_RANGE = 1   # outside the physical range configured for the measurement
+FLAG_SPIKE = 2   # too far from the median of recent good values
+FLAG_STEP = 4    # jump from the previous good value is too large
+FLAG_STUCK = 8   # value has repeated too many times in a row
+
+FLAG_NAMES = {
+    "range": FLAG_RANGE,
+    "spike": FLAG_SPIKE,
+    "step": FLAG_STEP,
+    "stuck": FLAG_STUCK,
+}
+
+
+def flag_names(flags):
+    """Return the names of the QC flags set in a flag bitmask."""
+    return [name for name, bit in FLAG_NAMES.items() if flags & bit]
+
+
+def as_float(value):
+    """Convert a reading to float, mapping anything non-numeric or non-finite to NaN (fails the range check)."""
+    if isinstance(value, bool):
+        return math.nan
+    try:
+        number = float(value)
+    except (TypeError, ValueError, OverflowError):
+        return math.nan
+    return number if math.isfinite(number) else math.nan
+
+
+class BatchQualityControl:
+    """Range, spike/step and stuck-sensor checks over batches of readings.
+
+    Args:
+        limits: Mapping of measurement name to a dict with optional
+            'min', 'max', 'spike' and 'step' values, and 'stuck' (default
+            True) to turn the stuck check off. Values sitting at 'min' are
+            never flagged as stuck (e.g. UV at night, PM in clean air).
+            Unknown measurements are only checked for being numeric and stuck.
+        history_size: Number of recent good values kept per series.
+        min_history: Values required before spike detection starts.
+        stuck_count: Consecutive repeats of the same value that flag a stuck sensor.
+        stuck_tolerance: Maximum difference still considered a repeat.
+        spike_reseed: Consecutive spikes, each within the spike limit of the
+            previous one, after which the series is treated as having shifted
+            level: the reading is accepted and the history restarts from it.
+        reject_flags: Flag names that cause a reading to be dropped;
+            the remaining flags are attached to the reading only.
+    """
+
+    def __init__(self, limits=None, history_size=16, min_history=4, stuck_count=12,
+                 stuck_tolerance=1e-6, spike_reseed=5, reject_flags=("range", "spike")):
+        self.history_size = int(history_size)
+        self.min_history = int(min_history)
+        self.stuck_count = int(stuck_count)
+        self.stuck_tolerance = float(stuck_tolerance)
+        self.spike_reseed = int(spike_reseed)
+        self.reject_mask = 0
+        for name in reject_flags:
+            self.reject_mask |= FLAG_NAMES[name]
+
+        # Measurement type 0 is the catch-all for measurements without limits
+        self._types = {}
+        rows = [(-np.inf, np.inf, np.inf, np.inf, 1.0)]
+        for index, (measurement, limit) in enumerate((limits or {}).items(), start=1):
+            limit = limit or {}
+            self._types[measurement] = index
+            rows.append((
+                limit.get('min', -np.inf),
+                limit.get('max', np.inf),
+                limit.get('spike', np.inf),
+                limit.get('step', np.inf),
+                1.0 if limit.get('stuck', True) else 0.0,
+            ))
+        table = np.array(rows, dtype=np.float64)
+        self._min, self._max, self._spike, self._step, stuck = table.T.copy()
+        self._stuck = stuck.astype(bool)
+
+        self._series = {}
+        self._capacity = 0
+        self._series_type = np.empty(0, dtype=np.intp)
+        self._last = np.empty(0, dtype=np.float64)
+        self._repeats = np.empty(0, dtype=np.int64)
+        self._history = np.empty((0, self.history_size), dtype=np.float64)
+        self._head = np.empty(0, dtype=np.int64)
+        self._filled = np.empty(0, dtype=np.int64)
+        self._spike_run = np.empty(0, dtype=np.int64)
+        self._spike_last = np.empty(0, dtype=np.float64)
+
+    def _grow(self, needed):
+        capacity = max(needed, 2 * self._capacity, 64)
+        extra = capacity - self._capacity
+        self._series_type = np.concatenate([self._series_type, np.zeros(extra, dtype=np.intp)])
+        self._last = np.concatenate([self._last, np.full(extra, np.nan)])
+        self._repeats = np.concatenate([self._repeats, np.zeros(extra, dtype=np.int64)])
+        self._history = np.vstack([self._history, np.full((extra, self.history_size), np.nan)])
+        self._head = np.concatenate([self._head, np.zeros(extra, dtype=np.int64)])
+        self._filled = np.concatenate([self._filled, np.zeros(extra, dtype=np.int64)])
+        self._spike_run = np.concatenate([self._spike_run, np.zeros(extra, dtype=np.int64)])
+        self._spike_last = np.concatenate([self._spike_last, np.full(extra, np.nan)])
+        self._capacity = capacity
+
+    def _series_index(self, key, measurement):
+        index = self._series.get(key)
+        if index is None:
+            index = len(self._series)
+            if index >= self._capacity:
+                self._grow(index + 1)
+            self._series[key] = index
+            self._series_type[index] = self._types.get(measurement, 0)
+        return index
+
+    def check(self, readings):
+        """Run all checks on a batch of readings.
+
+        Args:
+            readings: Sequence of (station_id, sensor, measurement, value) tuples,
+                in arrival order.
+
+        Returns:
+            Tuple of (flags, accepted) arrays aligned with the input: a uint8
+            bitmask of FLAG_* values and a boolean mask of readings to keep.
+        """
+        n = len(readings)
+        if n == 0:
+            return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=bool)
+
+        series = np.fromiter(
+            (self._series_index((station_id, sensor, measurement), measurement)
+             for station_id, sensor, measurement, _ in readings),
+            dtype=np.intp, count=n,
+        )
+        values = np.fromiter((as_float(reading[3]) for reading in readings), dtype=np.float64, count=n)
+
+        # Group readings by series while keeping arrival order inside each series
+        order = np.argsort(series, kind="stable")
+        s = series[order]
+        v = values[order]
+        t = self._series_type[s]
+        positions = np.arange(n)
+        starts = np.ones(n, dtype=bool)
+        starts[1:] = s[1:] != s[:-1]
+        ends = np.ones(n, dtype=bool)
+        ends[:-1] = s[1:] != s[:-1]
+        segment_start = np.maximum.accumulate(np.where(starts, positions, 0))
+        flags = np.zeros(n, dtype=np.uint8)
+
+        # Range check (NaN compares False, so non-numeric readings fail here)
+        in_range = (v >= self._min[t]) & (v <= self._max[t])
+        flags[~in_range] |= FLAG_RANGE
+
+        # Spike check against the median of recent good values from earlier batches
+        spike = np.zeros(n, dtype=bool)
+        candidates = np.flatnonzero(in_range & (self._filled[s] >= self.min_history))
+        if candidates.size:
+            median = np.nanmedian(self._history[s[candidates]], axis=1)
+            spike[candidates] = np.abs(v[candidates] - median) > self._spike[t[candidates]]
+
+        # A spike extends the current spike run when it is close to the previous spike,
+        # which may be the last reading of the previous batch
+        previous_value = np.empty(n)
+        previous_value[1:] = v[:-1]
+        previous_value[starts] = self._spike_last[s[starts]]
+        previous_spike = np.empty(n, dtype=bool)
+        previous_spike[1:] = spike[:-1]
+        previous_spike[starts] = self._spike_run[s[starts]] > 0
+        with np.errstate(invalid="ignore"):
+            close = np.abs(v - previous_value) <= self._spike[t]
+        linked, unbroken = self._run_length(spike & previous_spike & close, starts, segment_start, positions)
+        spike_run = np.where(spike, np.where(unbroken, linked + self._spike_run[s], linked + 1), 0)
+
+        # Enough agreeing spikes in a row mean the level really shifted: accept and re-seed
+        reseed = spike_run >= self.spike_reseed
+        flags[spike & ~reseed] |= FLAG_SPIKE
+        good = (flags & (FLAG_RANGE | FLAG_SPIKE)) == 0
+
+        # Previous good value of the same series: earlier in this batch, else carried state
+        last_good = np.maximum.accumulate(np.where(good, positions, -1))
+        prev_index = np.empty(n, dtype=np.intp)
+        prev_index[0] = -1
+        prev_index[1:] = last_good[:-1]
+        from_batch = prev_index >= segment_start
+        previous = np.where(from_batch, v[np.maximum(prev_index, 0)], self._last[s])
+
+        # Step check against the previous good value
+        with np.errstate(invalid="ignore"):
+            delta = np.abs(v - previous)
+        flags[in_range & (delta > self._step[t])] |= FLAG_STEP
+
+        # Stuck sensor: run length of consecutive repeats, continued from the previous batch
+        repeats, unbroken = self._run_length(delta <= self.stuck_tolerance, starts, segment_start, positions)
+        repeats = repeats + np.where(unbroken, self._repeats[s], 0)
+        stuck_checked = self._stuck[t] & (v > self._min[t])
+        flags[stuck_checked & (repeats >= self.stuck_count)] |= FLAG_STUCK
+
+        self._update_state(s, v, good, reseed, ends, repeats, spike_run, segment_start, positions)
+
+        accepted_sorted = (flags & self.reject_mask) == 0
+        result_flags = np.empty(n, dtype=np.uint8)
+        result_flags[order] = flags
+        accepted = np.empty(n, dtype=bool)
+        accepted[order] = accepted_sorted
+        return result_flags, accepted
+
+    @staticmethod
+    def _run_length(link, starts, segment_start, positions):
+        """Count consecutive True values of `link` ending at each position, per series.
+
+        Returns the counts and a mask of positions whose run reaches back to the
+        start of their series in this batch, i.e. where a run carried over from
+        the previous batch continues.
+        """
+        link_count = np.cumsum(link)
+        # Base to subtract: the count at the last False (run restarts after it), or just
+        # before a series start that is True (run restarts at it)
+        base = np.where(~link, link_count, np.where(starts, link_count - 1, 0))
+        run = link_count - np.maximum.accumulate(base)
+        last_break = np.maximum.accumulate(np.where(~link, positions, -1))
+        return run, last_break < segment_start
+
+    def _update_state(self, s, v, good, reseed, ends, repeats, spike_run, segment_start, positions):
+        self._repeats[s[ends]] = repeats[ends]
+        self._spike_run[s[ends]] = spike_run[ends]
+        self._spike_last[s[ends]] = v[ends]
+
+        # Last good value per series
+        good_positions = np.flatnonzero(good)
+        if good_positions.size:
+            good_series = s[good_positions]
+            last_of_series = np.ones(good_positions.size, dtype=bool)
+            last_of_series[:-1] = good_series[1:] != good_series[:-1]
+            self._last[good_series[last_of_series]] = v[good_positions[last_of_series]]
+
+        # Re-seeded series drop their history; only values from the first re-seed on are kept
+        append = good
+        if reseed.any():
+            reseeded = np.unique(s[reseed])
+            self._history[reseeded] = np.nan
+            self._head[reseeded] = 0
+            self._filled[reseeded] = 0
+            since_reseed = np.maximum.accumulate(np.where(reseed, positions, -1)) >= segment_start
+            series_reseeded = np.zeros(self._capacity, dtype=bool)
+            series_reseeded[reseeded] = True
+            append = good & (since_reseed | ~series_reseeded[s])
+
+        # Append values to each series' history ring; rank is the index among appended
+        # values of the same series in this batch
+        append_count = np.cumsum(append)
+        before_segment = append_count[segment_start] - append[segment_start]
+        rank = append_count - before_segment - 1
+        # Only the newest history_size values of each series can survive in the ring
+        series_total = np.bincount(s, weights=append, minlength=self._capacity).astype(np.int64)
+        keep = append & (rank >= series_total[s] - self.history_size)
+        if keep.any():
+            target = s[keep]
+            slot = (self._head[target] + rank[keep]) % self.history_size
+            self._history[target, slot] = v[keep]
+        touched = s[ends]
+        added = series_total[touched]
+        self._head[touched] = (self._head[touched] + added) % self.history_size
+        self._filled[touched] = np.minimum(self._filled[touched] + added, self.history_size)
@@ -0,0 +1,157 @@
+import math
+
+import numpy as np
+import pytest
+
+from quality_control import (
+    FLAG_RANGE,
+    FLAG_SPIKE,
+    FLAG_STEP,
+    FLAG_STUCK,
+    BatchQualityControl,
+    as_float,
+)
+
+TEMPERATURE_LIMITS = {"temperature": {'min': -50, 'max': 60, 'spike': 10, 'step': 5}}
+
+
+class LoopQualityControl:
+    """Per-reading reference implementation of the rules in BatchQualityControl."""
+
+    def __init__(self, qc):
+        self.qc = qc
+        self.state = {}
+
+    def _limits(self, measurement):
+        t = self.qc._types.get(measurement, 0)
+        return self.qc._min[t], self.qc._max[t], self.qc._spike[t], self.qc._step[t], self.qc._stuck[t]
+
+    def check(self, readings):
+        qc = self.qc
+        for station_id, sensor, measurement, _ in readings:
+            self.state.setdefault((station_id, sensor, measurement), {
+                "last": math.nan, "repeats": 0, "history": [], "spike_run": 0, "spike_last": math.nan,
+            })
+        # Spike checks compare against the history as it was before the batch
+        medians = {key: float(np.median(state["history"])) if len(state["history"]) >= qc.min_history else None
+                   for key, state in self.state.items()}
+        reseeded = set()
+        flags, accepted = [], []
+        for station_id, sensor, measurement, value in readings:
+            key = (station_id, sensor, measurement)
+            state = self.state[key]
+            low, high, spike_limit, step_limit, stuck_enabled = self._limits(measurement)
+            value = as_float(value)
+            flag = 0
+
+            in_range = low <= value <= high
+            if not in_range:
+                flag |= FLAG_RANGE
+
+            spike = in_range and medians[key] is not None and abs(value - medians[key]) > spike_limit
+            if spike:
+                close = abs(value - state["spike_last"]) <= spike_limit
+                state["spike_run"] = state["spike_run"] + 1 if state["spike_run"] > 0 and close else 1
+                state["spike_last"] = value
+            else:
+                state["spike_run"] = 0
+            reseed = spike and state["spike_run"] >= qc.spike_reseed
+            if spike and not reseed:
+                flag |= FLAG_SPIKE
+            if reseed and key not in reseeded:
+                reseeded.add(key)
+                state["history"] = []
+
+            delta = abs(value - state["last"])
+            if in_range and delta > step_limit:
+                flag |= FLAG_STEP
+            state["repeats"] = state["repeats"] + 1 if delta <= qc.stuck_tolerance else 0
+            if stuck_enabled and value > low and state["repeats"] >= qc.stuck_count:
+                flag |= FLAG_STUCK
+
+            if not flag & (FLAG_RANGE | FLAG_SPIKE):
+                state["last"] = value
+                state["history"] = (state["history"] + [value])[-qc.history_size:]
+            flags.append(flag)
+            accepted.append(not flag & qc.reject_mask)
+        return np.array(flags, dtype=np.uint8), np.array(accepted, dtype=bool)
+
+
+def test_as_float_rejects_non_numeric_and_non_finite():
+    assert as_float(3) == 3.0
+    assert as_float("2.5") == 2.5
+    for value in [None, True, "corrupt", ["1"], 10**400, "inf", "-Infinity", "nan"]:
+        assert math.isnan(as_float(value))
+
+
+def test_range_check_rejects_out_of_range_and_corrupt_values():
+    qc = BatchQualityControl(TEMPERATURE_LIMITS)
+    flags, accepted = qc.check([("station", "sensor", "temperature", value) for value in [20, 999, "corrupt", 21]])
+    assert (flags & FLAG_RANGE).tolist() == [0, FLAG_RANGE, FLAG_RANGE, 0]
+    assert accepted.tolist() == [True, False, False, True]
+
+
+def test_series_recovers_from_level_shift():
+    qc = BatchQualityControl(TEMPERATURE_LIMITS, spike_reseed=5)
+    for _ in range(4):
+        qc.check([("station", "sensor", "temperature", 5.0 + i * 0.1) for i in range(4)])
+    accepted = []
+    for _ in range(50):
+        _, batch_accepted = qc.check([("station", "sensor", "temperature", 17.0 + i * 0.1) for i in range(4)])
+        accepted.extend(batch_accepted.tolist())
+    assert accepted[:4] == [False] * 4
+    assert all(accepted[4:])
+
+
+def test_scattered_glitches_do_not_reseed():
+    qc = BatchQualityControl(TEMPERATURE_LIMITS, spike_reseed=5)
+    qc.check([("station", "sensor", "temperature", 5.0)] * 4)
+    _, accepted = qc.check([("station", "sensor", "temperature", value) for value in [40, -30] * 5])
+    assert not accepted.any()
+
+
+def test_constant_readings_at_min_or_with_stuck_disabled_are_not_stuck():
+    limits = {"uv": {'min': 0}, "co2": {'min': 250, 'stuck': False}, "humidity": {'min': 0}}
+    qc = BatchQualityControl(limits, stuck_count=3)
+    flags, _ = qc.check([("station", "ltr390", "uv", 0)] * 10
+                        + [("station", "scd40", "co2", 400)] * 10
+                        + [("station", "si7021", "humidity", 55)] * 10)
+    assert not (flags[:20] & FLAG_STUCK).any()
+    assert (flags[20:] & FLAG_STUCK).any()
+
+
+@pytest.mark.parametrize("history_size, min_history, stuck_count, spike_reseed, seed", [
+    (6, 2, 3, 3, 0),
+    (5, 3, 3, 3, 1),
+    (4, 4, 2, 2, 2),
+    (16, 4, 12, 5, 3),
+])
+def test_vectorized_checks_match_per_reading_reference(history_size, min_history, stuck_count, spike_reseed, seed):
+    # Few series, a short history and coarse values exercise ring wrap-around, repeats,
+    # level shifts and re-seeds within and across batches.
+    rng = np.random.default_rng(seed)
+    limits = {"temperature": {'min': -50, 'max': 60, 'spike': 10, 'step': 5},
+              "uv": {'min': 0, 'max': 20, 'spike': 5, 'step': 3, 'stuck': False}}
+    qc = BatchQualityControl(limits, history_size=history_size, min_history=min_history,
+                             stuck_count=stuck_count, spike_reseed=spike_reseed)
+    reference = LoopQualityControl(qc)
+    keys = [(f"station_{i}", "sensor", measurement) for i in range(2)
+            for measurement in ("temperature", "uv", "other")]
+    levels = [0.0, 15.0, 30.0, 45.0]
+    level = rng.choice(levels, len(keys))
+    for _ in range(300):
+        level = np.where(rng.random(len(keys)) < 0.15, rng.choice(levels, len(keys)), level)
+        batch = []
+        for k in rng.integers(0, len(keys), rng.integers(1, 60)).tolist():
+            roll = rng.random()
+            if roll < 0.05:
+                value = "corrupt"
+            elif roll < 0.1:
+                value = float(rng.choice([-99.0, 999.0, 40.0]))
+            else:
+                value = float(level[k] + rng.integers(0, 3))
+            batch.append((*keys[k], value))
+        flags, accepted = qc.check(batch)
+        expected_flags, expected_accepted = reference.check(batch)
+        assert np.array_equal(flags, expected_flags)
+        assert np.array_equal(accepted, expected_accepted)